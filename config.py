@@ -1,14 +1,42 @@
 
 import os
+import sys
+from dataclasses import dataclass
 from pathlib import Path
+from dotenv import load_dotenv
+
+# Setup environment first so Config's class body sees values from .env
+try:
+    # Try to get the file path if running as a script
+    PROJECT_ROOT = Path(__file__).parent
+except NameError:
+    # Fallback for Jupyter/Colab where __file__ is undefined
+    PROJECT_ROOT = Path(os.getcwd())
+
+ENV = PROJECT_ROOT / '.env'
+load_dotenv(ENV, override=True)
+
+
+@dataclass(frozen=True, slots=True)
+class Secrets:
+    """Notification credentials, read from the environment once (None disables a service)"""
+    imgur_id: str | None
+    whatsapp_phone: str | None
+    callmebot_key: str | None
+    telegram_token: str | None
+    telegram_chat_id: str | None
+
 
 class Config:
     # Directories
     BASE_DIR = Path(os.getcwd())
-    DETECTED_FIRES_DIR = BASE_DIR / "detected_events"
-    
-    # Create directory if it doesn't exist
-    DETECTED_FIRES_DIR.mkdir(exist_ok=True)
+    # Alert frames land on tmpfs on Linux to spare SD cards; the notification
+    # service rotates them into ARCHIVE_DIR once they are ARCHIVE_ROTATE_AFTER old
+    DETECTED_FIRES_DIR = Path(os.getenv(
+        "DETECTED_FIRES_DIR",
+        "/dev/shm/detected_events" if sys.platform == "linux" else BASE_DIR / "detected_events"))
+    ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", BASE_DIR / "detected_events"))
+    ARCHIVE_ROTATE_AFTER = 600  # Seconds
 
     # API Keys (Loaded from environment variables for security)
     # You must set these in your .env file or environment
@@ -19,3 +47,11 @@ class Config:
     
     # Alert Settings
     ALERT_COOLDOWN = 30  # Seconds
+    ALERT_JPEG_QUALITY = 75  # Quality of uploaded/archived alert images
+    ALERT_MAX_EDGE = 1280  # Pixels; larger frames are downscaled
+
+    @classmethod
+    def ensure_dirs(cls):
+        """Create the alert and archive directories if they don't exist"""
+        cls.DETECTED_FIRES_DIR.mkdir(parents=True, exist_ok=True)
+        cls.ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)